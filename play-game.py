@@ -1,128 +1,281 @@
-import requests
+import httpx
+import orjson
 import base64
-import json
+import io
+import logging
+import re
 import time
 import traceback
-from pathlib import Path
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from screenshot_lib import ScreenshotConfig, ScreenshotTool
+from PIL import Image
+import numpy as np
 import pyautogui
 
+logger = logging.getLogger(__name__)
+
+# Screen offset (dx, dy) in cells for each swipe direction
+_DIRS = {
+    'up': (0, -1),
+    'down': (0, 1),
+    'left': (-1, 0),
+    'right': (1, 0)
+}
+
+# Enhanced strategic prompt for Gemini, whitespace collapsed once so every
+# request sends the same compact prefix
+_PROMPT = re.sub(r'\s+', ' ', """
+Analyze this Candy Crush Saga game board as a strategic AI assistant. Think 3 moves ahead to create special candies and combinations.
+
+Special Candy Types to look for:
+- Striped Candy (4 in a row/column)
+- Wrapped Candy (L or T shape with 5 candies)
+- Color Bomb (5 in a row)
+- Swedish Fish (fish-shaped candy)
+
+For each possible move, analyze:
+1. Immediate match created
+2. Special candies that could be created
+3. Potential cascade effects
+4. Setup opportunities for next 2 moves
+5. How it advances level objectives
+
+Consider these priorities:
+1. Creating color bombs (highest priority)
+2. Setting up special candy combinations
+3. Creating wrapped or striped candies
+4. Moves that trigger cascades
+5. Moves that clear objectives
+
+Think through each step carefully:
+1. Scan for any existing special candies and their positions
+2. Identify all possible matches
+3. For each match, simulate the cascade effect
+4. Look for setups that could create special candies in future moves
+5. Evaluate which move creates the best chain of events
+
+Focus on creating combinations of special candies when possible, as these create the most powerful effects.
+
+Board coordinates start from top-left (0,0) and increase going right and down.
+Ensure all positions returned are valid board coordinates.
+
+Also return up to 2 followup_moves: further moves that are valid on this same board, away from the candies best_move and its cascades will clear, to be played in order after best_move without another analysis.
+""").strip()
+
+# Structured output schema for the Gemini reply
+_POSITION_SCHEMA = {
+    "type": "ARRAY",
+    "description": "[row, col]",
+    "items": {"type": "INTEGER", "minimum": 0, "maximum": 8},
+    "minItems": 2,
+    "maxItems": 2
+}
+_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "moves_left": {"type": "INTEGER"},
+        "current_objectives": {
+            "type": "OBJECT",
+            "properties": {
+                "type": {"type": "STRING", "description": "what needs to be collected/cleared"},
+                "target": {"type": "INTEGER"},
+                "current": {"type": "INTEGER"}
+            },
+            "required": ["type", "target", "current"]
+        },
+        "best_move": {
+            "type": "OBJECT",
+            "properties": {
+                "start_pos": _POSITION_SCHEMA,
+                "direction": {"type": "STRING", "enum": ["up", "down", "left", "right"]},
+                "immediate_outcome": {"type": "STRING", "description": "what happens right after the move"},
+                "cascade_potential": {"type": "STRING", "description": "likely cascade effects"},
+                "next_moves": {
+                    "type": "ARRAY",
+                    "items": {
+                        "type": "OBJECT",
+                        "properties": {
+                            "setup": {"type": "STRING", "description": "what this sets up for next move"},
+                            "position": _POSITION_SCHEMA,
+                            "special_candy": {"type": "STRING", "description": "type of special candy possible"}
+                        },
+                        "required": ["setup", "position", "special_candy"]
+                    }
+                }
+            },
+            "required": ["start_pos", "direction", "immediate_outcome", "cascade_potential", "next_moves"]
+        },
+        "followup_moves": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "start_pos": _POSITION_SCHEMA,
+                    "direction": {"type": "STRING", "enum": ["up", "down", "left", "right"]}
+                },
+                "required": ["start_pos", "direction"]
+            }
+        },
+        "special_candies": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "type": {"type": "STRING", "enum": ["striped", "wrapped", "color_bomb"]},
+                    "position": _POSITION_SCHEMA,
+                    "potential_combinations": {"type": "STRING"}
+                },
+                "required": ["type", "position", "potential_combinations"]
+            }
+        }
+    },
+    "required": ["moves_left", "current_objectives", "best_move", "followup_moves", "special_candies"]
+}
+
 class CandyCrushGeminiBot:
+    # Board hash -> move decision cache
+    CACHE_SIZE = 100
+    CACHE_MAX_DISTANCE = 6  # Max differing hash bits for a board to count as the same
+    HASH_SIZE = 18  # Hash samples per side, two per cell of the 9x9 board
+
+    # Board settle detection after a move
+    STABLE_THRESHOLD = 2.0  # Mean absolute pixel difference between two captures
+    STABLE_INTERVAL = 0.15
+    STABLE_TIMEOUT = 3.0
+
+    # Planned moves played without re-analyzing while the board around them is unchanged
+    MAX_FOLLOWUPS = 2
+    FOLLOWUP_CELL_THRESHOLD = 8.0  # Max mean absolute pixel difference of any single cell
+
+    # Gemini requests retried on rate limits and transient server errors
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = 0.5
+
     def __init__(self, api_key):
         self.api_key = api_key
         self.api_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
         self.screenshot_config = ScreenshotConfig()
         self.screenshot_tool = ScreenshotTool(self.screenshot_config)
+
+        # One HTTP/2 connection kept alive for the lifetime of the bot
+        self.client = httpx.Client(
+            headers={"x-goog-api-key": self.api_key},
+            timeout=httpx.Timeout(60, connect=5),
+            transport=httpx.HTTPTransport(
+                http2=True,
+                retries=3,
+                limits=httpx.Limits(max_connections=8, max_keepalive_connections=4)
+            )
+        )
+
+        # LRU cache of analyzed boards keyed by perceptual hash
+        self.move_cache = OrderedDict()
+        self.last_board_hash = None
         
-    def encode_image(self, image_path):
-        """Encode image to base64"""
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-
-    def analyze_with_gemini(self, image_path):
-        """Analyze game state using Gemini AI with enhanced strategic planning"""
-        base64_image = self.encode_image(image_path)
-        
-        # Enhanced strategic prompt for Gemini
-        prompt = """
-        Analyze this Candy Crush Saga game board as a strategic AI assistant. Think 3 moves ahead to create special candies and combinations.
-
-        Special Candy Types to look for:
-        - Striped Candy (4 in a row/column)
-        - Wrapped Candy (L or T shape with 5 candies)
-        - Color Bomb (5 in a row)
-        - Swedish Fish (fish-shaped candy)
-
-        For each possible move, analyze:
-        1. Immediate match created
-        2. Special candies that could be created
-        3. Potential cascade effects
-        4. Setup opportunities for next 2 moves
-        5. How it advances level objectives
-
-        Consider these priorities:
-        1. Creating color bombs (highest priority)
-        2. Setting up special candy combinations
-        3. Creating wrapped or striped candies
-        4. Moves that trigger cascades
-        5. Moves that clear objectives
-        
-        Return your analysis in this exact JSON format:
-        {
-            "moves_left": number,
-            "current_objectives": {
-                "type": "description of what needs to be collected/cleared",
-                "target": number,
-                "current": number
-            },
-            "best_move": {
-                "start_pos": [row, col],
-                "direction": "up/down/left/right",
-                "immediate_outcome": "what happens right after the move",
-                "cascade_potential": "description of likely cascade effects",
-                "next_moves": [
-                    {
-                        "setup": "what this sets up for next move",
-                        "position": [row, col],
-                        "special_candy": "type of special candy possible"
-                    }
-                ]
-            },
-            "special_candies": [
-                {
-                    "type": "striped/wrapped/color_bomb",
-                    "position": [row, col],
-                    "potential_combinations": "description of possible combinations"
-                }
-            ]
-        }
+    def _post(self, url, **kwargs):
+        """POST with exponential backoff on retryable statuses"""
+        for attempt in range(self.MAX_RETRIES + 1):
+            response = self.client.post(url, **kwargs)
+            if response.status_code not in self.RETRY_STATUSES or attempt == self.MAX_RETRIES:
+                break
+            time.sleep(self.RETRY_BACKOFF * 2 ** attempt)
+        
+        response.raise_for_status()
+        return response
 
-        Think through each step carefully:
-        1. Scan for any existing special candies and their positions
-        2. Identify all possible matches
-        3. For each match, simulate the cascade effect
-        4. Look for setups that could create special candies in future moves
-        5. Evaluate which move creates the best chain of events
-
-        Focus on creating combinations of special candies when possible, as these create the most powerful effects.
-
-        Board coordinates start from top-left (0,0) and increase going right and down.
-        Ensure all positions returned are valid board coordinates.
-        """
-
-        # Prepare the request payload
-        payload = {
-            "contents": [{
-                "parts": [
-                    {"text": prompt},
-                    {
-                        "inline_data": {
-                            "mime_type": "image/png",
-                            "data": base64_image
-                        }
-                    }
-                ]
-            }]
-        }
+    def board_hash(self, image_data):
+        """Compute a difference hash of the board image, finer than its cell grid"""
+        with Image.open(io.BytesIO(image_data)) as image:
+            gray = image.convert('L').resize((self.HASH_SIZE + 1, self.HASH_SIZE), Image.LANCZOS)
+        
+        pixels = np.asarray(gray, dtype=np.int16)
+        bits = (pixels[:, :-1] > pixels[:, 1:]).flatten()
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
 
+    def lookup_cached_move(self, board_hash):
+        """Return the cached best move of the closest matching board, if any"""
+        best_hash, best_distance = None, self.CACHE_MAX_DISTANCE + 1
+        for cached_hash in self.move_cache:
+            distance = bin(cached_hash ^ board_hash).count('1')
+            if distance < best_distance:
+                best_hash, best_distance = cached_hash, distance
+        
+        if best_hash is None:
+            return None
+        
+        # The board did not change after playing this decision, so ask again
+        if best_hash == self.last_board_hash:
+            del self.move_cache[best_hash]
+            return None
+        
+        self.move_cache.move_to_end(best_hash)
+        self.last_board_hash = best_hash
+        return self.move_cache[best_hash]
+
+    def cache_move(self, board_hash, game_state):
+        """Store the best move of an analyzed board, evicting the least recently used one"""
+        self.last_board_hash = board_hash
+        if game_state['moves_left'] <= 0:
+            return
+        
+        # Counts and objectives go stale as the level progresses, only the move is reusable
+        self.move_cache[board_hash] = game_state['best_move']
+        self.move_cache.move_to_end(board_hash)
+        if len(self.move_cache) > self.CACHE_SIZE:
+            self.move_cache.popitem(last=False)
+
+    def analyze_with_gemini(self, image_data):
+        """Analyze game state using Gemini AI, returning (game_state, from_cache); a cache hit holds only best_move"""
+        board_hash = self.board_hash(image_data)
+        cached_move = self.lookup_cached_move(board_hash)
+        if cached_move:
+            return {'best_move': cached_move}, True
+        
         # Make the API request
         try:
-            response = requests.post(
-                f"{self.api_url}?key={self.api_key}",
-                json=payload
+            # The downscaled JPEG is small enough to send inline, saving a Files API round trip
+            encoded_image = base64.b64encode(image_data).decode('utf-8')
+            
+            # Stable prompt prefix first, only the board image varies per call
+            payload = {
+                "system_instruction": {
+                    "parts": [{"text": _PROMPT}]
+                },
+                "contents": [{
+                    "role": "user",
+                    "parts": [{
+                        "inline_data": {
+                            "mime_type": self.screenshot_tool.MIME_TYPE,
+                            "data": encoded_image
+                        }
+                    }]
+                }],
+                "generationConfig": {
+                    "response_mime_type": "application/json",
+                    "response_schema": _RESPONSE_SCHEMA
+                }
+            }
+            
+            response = self._post(
+                self.api_url,
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"}
             )
-            response.raise_for_status()
             
-            # Parse and return the AI response
-            result = response.json()
+            # Parse the raw body once, skipping text decoding
+            result = orjson.loads(response.content)
             text_response = result['candidates'][0]['content']['parts'][0]['text']
-            json_str = text_response[text_response.find('{'):text_response.rfind('}')+1]
-            return json.loads(json_str)
+            game_state = orjson.loads(text_response)
+            self.cache_move(board_hash, game_state)
+            return game_state, False
             
         except Exception as e:
             print(f"Error analyzing game state: {e}")
-            traceback.print_exc()
-            return None
+            if logger.isEnabledFor(logging.DEBUG):
+                traceback.print_exc()
+            return None, False
 
     def print_analysis(self, game_state):
         """Print detailed analysis of the game state"""
@@ -149,31 +302,29 @@ class CandyCrushGeminiBot:
                 print(f"- {candy['type']} at Row {candy['position'][0]}, Col {candy['position'][1]}")
                 print(f"  Potential: {candy['potential_combinations']}")
 
+    def _compute_geometry(self):
+        """Precompute board cell geometry once the region is known"""
+        region = self.screenshot_config.region
+        board_width = region[2] - region[0]
+        board_height = region[3] - region[1]
+        self._cell_size = min(board_width, board_height) // 9  # Assuming standard 9x9 board
+        self._half_cell = self._cell_size // 2
+        self._origin_x = region[0]
+        self._origin_y = region[1]
+
     def make_move(self, move_info):
         """Execute the move based on AI analysis"""
         try:
-            # Calculate cell size based on region
-            region = self.screenshot_config.region
-            board_width = region[2] - region[0]
-            board_height = region[3] - region[1]
-            cell_size = min(board_width, board_height) // 9  # Assuming standard 9x9 board
-            
             # Get start position
             row, col = move_info['start_pos']
-            start_x = region[0] + (col * cell_size) + (cell_size // 2)
-            start_y = region[1] + (row * cell_size) + (cell_size // 2)
+            start_x = self._origin_x + (col * self._cell_size) + self._half_cell
+            start_y = self._origin_y + (row * self._cell_size) + self._half_cell
             
             # Calculate end position based on direction
-            direction_map = {
-                'up': (0, -1),
-                'down': (0, 1),
-                'left': (-1, 0),
-                'right': (1, 0)
-            }
-            dx, dy = direction_map[move_info['direction']]
+            dx, dy = _DIRS[move_info['direction']]
             
-            end_x = start_x + (dx * cell_size)
-            end_y = start_y + (dy * cell_size)
+            end_x = start_x + (dx * self._cell_size)
+            end_y = start_y + (dy * self._cell_size)
             
             # Execute move
             pyautogui.moveTo(start_x, start_y)
@@ -184,55 +335,147 @@ class CandyCrushGeminiBot:
             
         except Exception as e:
             print(f"Error executing move: {e}")
-            traceback.print_exc()
+            if logger.isEnabledFor(logging.DEBUG):
+                traceback.print_exc()
 
     def play_game(self):
+        """Play until the game ends, then release the HTTP client"""
+        try:
+            self._play()
+        finally:
+            # Shut the HTTP/2 connection down cleanly however the game ends
+            self.client.close()
+
+    def _play(self):
         """Main game loop"""
         print("Starting Candy Crush Bot with Gemini AI...")
         print("Please select the game board area...")
         
         # Initial region selection
         self.screenshot_tool.select_region()
+        self._compute_geometry()
         
-        while True:
-            try:
-                # Capture current game state
-                image_path = self.capture_game_state()
-                
-                # Get Gemini AI analysis
-                game_state = self.analyze_with_gemini(image_path)
-                
-                if not game_state:
-                    print("Could not analyze game state")
-                    continue
-                
-                # Print detailed analysis
-                self.print_analysis(game_state)
-                
-                # Check if we should continue
-                if game_state['moves_left'] <= 0:
-                    print("Game finished!")
+        # The worker plays each move and captures the settled board while the
+        # main thread prints the analysis of the move being played
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_frame = executor.submit(self.capture_game_state)
+            pending_moves = deque()
+            plan_frame = None
+            
+            while True:
+                try:
+                    # Wait for the current game state capture
+                    frame, image_data = next_frame.result()
+                    
+                    # Play the next planned move while its part of the board is as analyzed
+                    if pending_moves:
+                        move = pending_moves.popleft()
+                        if self._followup_still_valid(move, plan_frame, frame):
+                            print(f"\nPlaying planned follow-up: Row {move['start_pos'][0]}, "
+                                  f"Col {move['start_pos'][1]}, {move['direction']}")
+                            next_frame = executor.submit(self.play_move, move)
+                            continue
+                        pending_moves.clear()
+                    
+                    # Get Gemini AI analysis
+                    game_state, from_cache = self.analyze_with_gemini(image_data)
+                    
+                    if not game_state:
+                        print("Could not analyze game state")
+                        next_frame = executor.submit(self.capture_game_state)
+                        continue
+                    
+                    # Only the move of a cached board is reused, its counts belong to an older board
+                    if from_cache:
+                        move = game_state['best_move']
+                        print(f"\nReusing cached move: Row {move['start_pos'][0]}, "
+                              f"Col {move['start_pos'][1]}, {move['direction']}")
+                        pending_moves.clear()
+                        next_frame = executor.submit(self.play_move, move)
+                        continue
+                    
+                    # Execute best move and capture the next state in the background
+                    finished = game_state['moves_left'] <= 0
+                    if not finished:
+                        next_frame = executor.submit(self.play_move, game_state['best_move'])
+                        
+                        # Queue the follow-ups, never more than the moves left after this one
+                        followups = game_state.get('followup_moves', [])
+                        pending_moves = deque(followups[:min(self.MAX_FOLLOWUPS, game_state['moves_left'] - 1)])
+                        plan_frame = frame
+                    
+                    # Print detailed analysis
+                    self.print_analysis(game_state)
+                    
+                    # Check if we should continue
+                    if finished:
+                        print("Game finished!")
+                        break
+                    
+                except KeyboardInterrupt:
+                    print("\nBot stopped by user")
                     break
-                
-                # Execute best move
-                self.make_move(game_state['best_move'])
-                
-                # Wait for animations and board updates
-                time.sleep(2)
-                
-            except KeyboardInterrupt:
-                print("\nBot stopped by user")
-                break
-            except Exception as e:
-                print(f"Error in game loop: {e}")
-                traceback.print_exc()
-                break
+                except Exception as e:
+                    print(f"Error in game loop: {e}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        traceback.print_exc()
+                    break
+
+    def play_move(self, move_info):
+        """Execute a move, wait for the board to settle and capture it"""
+        self.make_move(move_info)
+        
+        # Wait for animations and board updates
+        self._wait_stable()
+        
+        return self.capture_game_state()
+
+    def _wait_stable(self, threshold=STABLE_THRESHOLD):
+        """Wait until two consecutive captures barely differ or the timeout expires"""
+        deadline = time.monotonic() + self.STABLE_TIMEOUT
+        previous = np.asarray(self.screenshot_tool.grab_frame(), dtype=np.int16)
+        while time.monotonic() < deadline:
+            time.sleep(self.STABLE_INTERVAL)
+            current = np.asarray(self.screenshot_tool.grab_frame(), dtype=np.int16)
+            if np.abs(current - previous).mean() < threshold:
+                return True
+            previous = current
+        return False
+
+    def _followup_still_valid(self, move_info, plan_frame, frame):
+        """Check the board around a planned move is unchanged since it was planned"""
+        try:
+            # Both swapped cells must be on the 9x9 board, or the drag lands on game UI
+            row, col = move_info['start_pos']
+            dx, dy = _DIRS[move_info['direction']]
+            if not (0 <= row < 9 and 0 <= col < 9 and 0 <= row + dy < 9 and 0 <= col + dx < 9):
+                print("Discarding planned follow-up: swap leaves the board")
+                return False
+            return self._followup_window_unchanged(move_info, plan_frame, frame)
+        except Exception as e:
+            # A malformed planned move is treated as stale and the board re-analyzed
+            print(f"Discarding planned follow-up: {e}")
+            return False
+
+    def _followup_window_unchanged(self, move_info, plan_frame, frame):
+        """Compare the cells a planned move's match depends on between two frames"""
+        # A swap only forms matches with candies up to two cells away
+        row, col = move_info['start_pos']
+        dx, dy = _DIRS[move_info['direction']]
+        cell = min(frame.shape[:2]) // 9
+        top, bottom = max(min(row, row + dy) - 2, 0), min(max(row, row + dy) + 3, 9)
+        left, right = max(min(col, col + dx) - 2, 0), min(max(col, col + dx) + 3, 9)
+        
+        # A single changed candy can break the match, so compare cell by cell
+        window = (slice(top * cell, bottom * cell), slice(left * cell, right * cell))
+        diff = np.abs(frame[window] - plan_frame[window])
+        cell_diffs = diff.reshape(bottom - top, cell, right - left, cell, -1).mean(axis=(1, 3, 4))
+        return cell_diffs.max() < self.FOLLOWUP_CELL_THRESHOLD
 
     def capture_game_state(self):
-        """Capture the current game state"""
-        self.screenshot_tool.take_screenshot()
-        latest_screenshot = max(Path(self.screenshot_config.save_dir).glob('*.png'))
-        return latest_screenshot
+        """Capture the current game state as a raw frame and in-memory JPEG bytes"""
+        frame = self.screenshot_tool.grab_frame()
+        return np.asarray(frame, dtype=np.int16), self.screenshot_tool.encode_frame(frame)
 
 if __name__ == "__main__":
     GEMINI_API_KEY = "GEMINI_API_KEY"  # Replace with your actual Gemini API key
@@ -1,13 +1,17 @@
+import io
+import os
 import time
 import yaml
 import logging
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime
 import sys
 import traceback
-from PIL import ImageGrab
+from PIL import Image
+import mss
 import tkinter as tk
-from typing import Dict, Tuple, Optional
+from typing import Deque, Dict, Tuple, Optional
+from collections import deque
 import threading
 from concurrent.futures import ThreadPoolExecutor
 
@@ -21,6 +25,7 @@ class ScreenshotConfig:
         self.file_prefix: str = "screenshot"
         self.retention_minutes: int = 1
         self.selection_mode: str = "manual"
+        self.debug: bool = False
         self.load_config()
 
     def load_config(self) -> None:
@@ -35,6 +40,7 @@ class ScreenshotConfig:
             self.file_prefix = config.get('file_prefix', 'screenshot')
             self.retention_minutes = config.get('retention_minutes', 1)
             self.selection_mode = config.get('selection_mode', 'manual')
+            self.debug = config.get('debug', False)
             
         except FileNotFoundError:
             logging.warning(f"Config file not found at {self.config_path}. Using default values.")
@@ -54,7 +60,8 @@ class ScreenshotConfig:
             'region': [],
             'file_prefix': 'screenshot',
             'retention_minutes': 1,
-            'selection_mode': 'manual'
+            'selection_mode': 'manual',
+            'debug': False
         }
         try:
             with open(self.config_path, 'w') as f:
@@ -107,17 +114,36 @@ class RegionSelector:
         return self.region
 
 class ScreenshotTool:
+    # Encoding of the in-memory captures sent for analysis
+    MIME_TYPE = "image/jpeg"
+    MAX_SIZE = (768, 768)
+    JPEG_QUALITY = 75
+    RECENT_FRAMES = 5
+
     def __init__(self, config: ScreenshotConfig):
         """Initialize the screenshot tool with configuration."""
         self.config = config
         self.setup_logging()
         self.setup_directory()
         self.running = False
+        self.last_path: Optional[Path] = None
+        self._local = threading.local()
+        # Ring of the latest captures taken by start(in_memory=True) as (timestamp, bytes)
+        self.recent_frames: Deque[Tuple[float, bytes]] = deque(maxlen=self.RECENT_FRAMES)
+        # Debug PNGs written by encode_frame as (timestamp, path), oldest first
+        self._debug_paths: Deque[Tuple[float, Path]] = deque()
 
     def setup_logging(self) -> None:
-        """Configure logging with file and console output."""
+        """Configure logging with file and console output, once per process."""
+        # HTTP client debug output echoes request URLs and headers, API key included
+        for name in ('urllib3', 'httpx', 'httpcore', 'hpack', 'h2'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+        if logging.getLogger().hasHandlers():
+            return
+        # Per-capture messages are debug only, keep the hot path quiet in production
         logging.basicConfig(
-            level=logging.INFO,
+            level=logging.DEBUG if self.config.debug else logging.WARNING,
             format='%(asctime)s - %(levelname)s - %(message)s',
             handlers=[
                 logging.FileHandler('screenshot_tool.log'),
@@ -153,23 +179,81 @@ class ScreenshotTool:
                 logging.error(f"Error selecting region: {e}")
                 raise
 
-    def take_screenshot(self) -> None:
-        """Take a screenshot of the selected region."""
+    def take_screenshot(self) -> Optional[Path]:
+        """Take a screenshot of the selected region and return its path."""
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"{self.config.file_prefix}_{timestamp}.png"
-            filepath = Path(self.config.save_dir) / filename
-
-            screenshot = ImageGrab.grab(bbox=self.config.region)
-            screenshot.save(filepath)
-            logging.info(f"Screenshot saved: {filepath}")
+            screenshot = self.grab_frame()
+            return self._save_screenshot(screenshot)
             
         except Exception as e:
             logging.error(f"Error taking screenshot: {e}")
             logging.debug(traceback.format_exc())
+            return None
+
+    def _grabber(self):
+        """Return the mss instance of the calling thread, created on first use."""
+        # mss handles are bound to the thread that opened them
+        sct = getattr(self._local, 'sct', None)
+        if sct is None:
+            sct = self._local.sct = mss.mss()
+        return sct
+
+    def grab_frame(self) -> Image.Image:
+        """Grab the selected region straight from the screen buffer."""
+        sct = self._grabber()
+        if self.config.region:
+            x1, y1, x2, y2 = self.config.region
+            monitor = {'left': x1, 'top': y1, 'width': x2 - x1, 'height': y2 - y1}
+        else:
+            monitor = sct.monitors[0]
+        raw = sct.grab(monitor)
+        return Image.frombytes('RGB', raw.size, raw.rgb)
+
+    def _save_screenshot(self, screenshot: Image.Image) -> Path:
+        """Save a full resolution PNG of the screenshot to the save directory."""
+        # Microseconds keep captures within the same second from overwriting each other
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        filename = f"{self.config.file_prefix}_{timestamp}.png"
+        filepath = Path(self.config.save_dir) / filename
+
+        screenshot.save(filepath)
+        logging.debug("Screenshot saved: %s", filepath)
+        self.last_path = filepath
+        return filepath
+
+    def grab_bytes(self) -> bytes:
+        """Capture the selected region as downscaled JPEG bytes without touching the disk."""
+        return self.encode_frame(self.grab_frame())
 
-    def start(self) -> None:
-        """Start taking screenshots at configured interval."""
+    def encode_frame(self, screenshot: Image.Image) -> bytes:
+        """Encode a captured frame as downscaled JPEG bytes, leaving the frame untouched."""
+        if self.config.debug:
+            self._save_debug_screenshot(screenshot)
+        
+        # Enough resolution to tell candies apart at a fraction of the upload size
+        screenshot = screenshot.copy()
+        screenshot.thumbnail(self.MAX_SIZE, Image.LANCZOS)
+        buffer = io.BytesIO()
+        screenshot.save(buffer, format='JPEG', quality=self.JPEG_QUALITY, optimize=False)
+        return buffer.getvalue()
+
+    def _save_debug_screenshot(self, screenshot: Image.Image) -> None:
+        """Save a debug PNG, deleting debug PNGs older than retention_minutes."""
+        now = time.time()
+        self._debug_paths.append((now, self._save_screenshot(screenshot)))
+        
+        # No ImageCleaner runs alongside in-memory capture, so prune here
+        cutoff = now - self.config.retention_minutes * 60
+        while self._debug_paths and self._debug_paths[0][0] < cutoff:
+            _, old_path = self._debug_paths.popleft()
+            try:
+                old_path.unlink()
+                logging.debug("Deleted old screenshot: %s", old_path)
+            except OSError as e:
+                logging.error(f"Error deleting file {old_path}: {e}")
+
+    def start(self, in_memory: bool = False) -> None:
+        """Start taking screenshots at configured interval, kept in memory or saved to disk."""
         try:
             self.running = True
             self.select_region()
@@ -178,7 +262,10 @@ class ScreenshotTool:
             print("Press Ctrl+C to stop...\n")
             
             while self.running:
-                self.take_screenshot()
+                if in_memory:
+                    self.recent_frames.append((time.time(), self.grab_bytes()))
+                else:
+                    self.take_screenshot()
                 time.sleep(self.config.interval_ms / 1000)
                 
         except KeyboardInterrupt:
@@ -221,46 +308,51 @@ class ImageCleaner:
     def cleanup_old_images(self):
         """Delete images older than retention_minutes."""
         try:
-            cutoff_time = datetime.now() - timedelta(minutes=self.config.retention_minutes)
-            screenshot_dir = Path(self.config.save_dir)
+            cutoff = time.time() - self.config.retention_minutes * 60
+            prefix = f"{self.config.file_prefix}_"
 
-            for image_path in screenshot_dir.glob(f"{self.config.file_prefix}_*.png"):
-                try:
-                    timestamp_str = image_path.stem.split('_', 1)[1]
-                    image_time = datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S")
-
-                    if image_time < cutoff_time:
-                        image_path.unlink()
-                        logging.info(f"Deleted old screenshot: {image_path}")
-                except (ValueError, OSError) as e:
-                    logging.error(f"Error processing file {image_path}: {e}")
+            with os.scandir(self.config.save_dir) as entries:
+                for entry in entries:
+                    if not (entry.name.startswith(prefix) and entry.name.endswith('.png')):
+                        continue
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            os.unlink(entry.path)
+                            logging.debug("Deleted old screenshot: %s", entry.path)
+                    except OSError as e:
+                        logging.error(f"Error processing file {entry.path}: {e}")
 
         except Exception as e:
             logging.error(f"Error cleaning up old images: {e}")
             raise
 
 class ScreenshotManager:
-    def __init__(self, config: ScreenshotConfig):
+    def __init__(self, config: ScreenshotConfig, in_memory: bool = False,
+                 screenshot_tool: Optional[ScreenshotTool] = None):
         self.config = config
-        self.screenshot_tool = ScreenshotTool(config)
+        self.in_memory = in_memory
+        # Share an existing tool rather than setting up a second capture backend
+        self.screenshot_tool = screenshot_tool or ScreenshotTool(config)
         self.image_cleaner = ImageCleaner(config)
         self.running = False
 
     def start(self):
-        """Start both screenshot capture and cleanup processes."""
+        """Start screenshot capture, plus disk cleanup unless captures stay in memory."""
         try:
             print("Starting Screenshot Manager...")
-            # Start the image cleaner
-            self.image_cleaner.start()
-            logging.info("Image cleaner started")
+            # In-memory captures live in a bounded ring, nothing to clean up on disk
+            if not self.in_memory:
+                self.image_cleaner.start()
+                logging.info("Image cleaner started")
             
             # Start screenshot capture
-            self.screenshot_tool.start()
+            self.screenshot_tool.start(in_memory=self.in_memory)
             
         except Exception as e:
             logging.error(f"Error in screenshot manager: {e}")
             raise
         finally:
             # Ensure cleanup stops when screenshots stop
-            self.image_cleaner.stop()
-            logging.info("Image cleaner stopped")
\ No newline at end of file
+            if self.image_cleaner.running:
+                self.image_cleaner.stop()
+                logging.info("Image cleaner stopped")
\ No newline at end of file